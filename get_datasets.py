@@ -7,54 +7,306 @@ Oxford Robotics Institute, Oxford University.
 
 '''
 
-import requests
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+from lxml import etree
+import os
 import re
+from urllib.parse import urljoin
+import urllib3
+from urllib3.util.retry import Retry
 
 from scrape_mrgdatashare import datasets_url
 
+# urls
+bulk_listing_url = datasets_url + "index.json"
 
-def main():
-    # open session
-    session_requests = requests.session()
+# parsing - dataset names follow the datasets url in each dataset link, sensor
+# types sit between the doubled dataset name and the archive extension in
+# each download link
+dataset_regex = re.compile(re.escape(datasets_url) + r"([^/]{19})/?$")
+sensor_type_regex = re.compile(
+    r"download/\?filename=datasets/[^/]{19}/[^/]{19}_([^/\"<>]*?)\.tar")
+
+# responses
+good_status_code = 200
+not_modified_status_code = 304
+
+# filesystem - validators and bodies of previous responses, for conditional GETs
+default_cache_dir = ".mrg_cache"
+
+# streaming - pages are parsed as chunks arrive (bytes)
+default_chunk_length = 64 * 1024
+
+# concurrency params - number of dataset pages fetched at once
+default_max_workers = 16
+
+# retry params - transient server errors are retried with backoff (seconds)
+default_nb_retries = 3
+default_retry_backoff = 0.3
+retry_status_codes = [429, 500, 502, 503, 504]
+
+
+def iter_page(pool_manager, url, cache_dir):
+    """Streams a page, revalidating any previous copy cached on disk.
+
+    Args:
+        pool_manager (urllib3.PoolManager): Shared connection pool.
+        url (string): Page to get.
+        cache_dir (string): Directory holding cached responses.
+
+    Yields:
+        bytes: Chunks of the page body.
+
+    """
+
+    # cached validators and body for this url
+    cache_stem = os.path.join(cache_dir, hashlib.sha1(url.encode()).hexdigest())
+    cache_file = cache_stem + ".json"
+    body_file = cache_stem + ".html"
+    cached = None
+    if os.path.exists(cache_file) and os.path.exists(body_file):
+        with open(cache_file, "r") as file_handle:
+            cached = json.load(file_handle)
+
+    # conditional request, on top of the pool's default headers
+    headers = dict(pool_manager.headers)
+    if cached:
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+    result = pool_manager.request(
+        "GET", url, headers=headers, preload_content=False)
+
+    # unchanged since last run, no body was sent
+    if cached and result.status == not_modified_status_code:
+        result.release_conn()
+        with open(body_file, "rb") as file_handle:
+            for chunk in iter(
+                    lambda: file_handle.read(default_chunk_length), b""):
+                yield chunk
+        return
+
+    # nothing to revalidate against next run
+    etag = result.headers.get("ETag")
+    last_modified = result.headers.get("Last-Modified")
+    if result.status != good_status_code or not (etag or last_modified):
+        for chunk in result.stream(default_chunk_length):
+            yield chunk
+        result.release_conn()
+        return
+
+    # keep a copy of the body as it streams past, and its validators
+    with open(body_file + ".part", "wb") as file_handle:
+        for chunk in result.stream(default_chunk_length):
+            file_handle.write(chunk)
+            yield chunk
+    result.release_conn()
+    os.replace(body_file + ".part", body_file)
+    with open(cache_file, "w") as file_handle:
+        json.dump({"etag": etag, "last_modified": last_modified}, file_handle)
+
+
+def get_links(chunks, url):
+    """Incrementally parses a page for the targets of its anchors.
+
+    Args:
+        chunks (iterable): Chunks of the page body.
+        url (string): Page address, used to resolve relative links.
+
+    Returns:
+        list: Absolute link targets.
+
+    """
+
+    links = []
+    parser = etree.HTMLPullParser(events=("end",), tag="a")
+
+    def read_links():
+        for _, element in parser.read_events():
+            href = element.get("href")
+            if href:
+                links.append(urljoin(url, href))
+            # anchors are not needed once their target is read
+            element.clear()
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        read_links()
+    parser.close()
+    read_links()
+
+    return links
+
+
+def get_dataset_ids(pool_manager, cache_dir):
+    """Scrapes the index page for the datasets available for download.
+
+    Args:
+        pool_manager (urllib3.PoolManager): Shared connection pool.
+        cache_dir (string): Directory holding cached responses.
+
+    Returns:
+        list: Sorted unique datasets.
+
+    """
 
     # get http response from website
-    result = session_requests.get(datasets_url)
-    text = result.text
+    links = get_links(
+        iter_page(pool_manager, datasets_url, cache_dir), datasets_url)
+
+    # parse links, links to metadata pages do not match
+    datasets = {match.group(1)
+                for match in map(dataset_regex.match, links)
+                if match}
+
+    # sort unique datasets
+    return sorted(datasets)
+
+
+def fetch(pool_manager, dataset, cache_dir):
+    """Scrapes a dataset page for the sensor types available for download.
+
+    Args:
+        pool_manager (urllib3.PoolManager): Shared connection pool.
+        dataset (string): Dataset to scrape.
+        cache_dir (string): Directory holding cached responses.
+
+    Returns:
+        tuple: Dataset and list of sensor types.
+
+    """
+
+    # url to dataset page
+    dataset_url = datasets_url + dataset
+    links = get_links(
+        iter_page(pool_manager, dataset_url, cache_dir), dataset_url)
+
+    # parse links for sensor type
+    sensor_types = [match.group(1)
+                    for match in map(sensor_type_regex.search, links)
+                    if match]
+
+    return dataset, sensor_types
+
+
+def fetch_bulk(pool_manager):
+    """Gets sensor types for every dataset from a single listing, if served.
+
+    Args:
+        pool_manager (urllib3.PoolManager): Shared connection pool.
+
+    Returns:
+        dict: Sensor types keyed by dataset, empty if there is no listing.
+
+    """
+
+    # the listing is optional, so any failure falls back to scraping pages
+    # rather than being retried
+    try:
+        result = pool_manager.request("GET", bulk_listing_url, retries=False)
+    except urllib3.exceptions.HTTPError:
+        return {}
+    if result.status != good_status_code or \
+            "json" not in result.headers.get("content-type", ""):
+        return {}
+    try:
+        listing = json.loads(result.data)
+    except ValueError:
+        return {}
+    if not isinstance(listing, dict):
+        return {}
+
+    # datasets without a list of sensor types are scraped instead
+    return {dataset: sensor_types
+            for dataset, sensor_types in listing.items()
+            if isinstance(sensor_types, list) and
+            all(isinstance(sensor_type, str) for sensor_type in sensor_types)}
+
+
+def fetch_all_sensor_types(pool_manager, datasets, cache_dir,
+                           max_workers):
+    """Gets sensor types for datasets, scraping pages only where needed.
+
+    Args:
+        pool_manager (urllib3.PoolManager): Shared connection pool.
+        datasets (list): Datasets to look up.
+        cache_dir (string): Directory holding cached responses.
+        max_workers (int): Number of dataset pages to fetch concurrently.
+
+    Returns:
+        dict: Sensor types keyed by dataset.
+
+    """
+
+    # one request for everything the listing covers
+    bulk = fetch_bulk(pool_manager)
+    sensor_types = {dataset: bulk[dataset]
+                    for dataset in datasets if dataset in bulk}
+
+    # fall back to scraping dataset pages concurrently
+    missing = [dataset for dataset in datasets if dataset not in bulk]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        sensor_types.update(executor.map(
+            lambda dataset: fetch(pool_manager, dataset, cache_dir),
+            missing))
+
+    return sensor_types
+
+
+def main():
+    # option parsing suite
+    argument_parser = argparse.ArgumentParser(
+        description="GetDatasets input parameters")
+    argument_parser.add_argument(
+        "--max_workers",
+        dest="max_workers",
+        type=int,
+        default=default_max_workers,
+        help="Number of dataset pages to fetch concurrently e.g. " +
+             str(default_max_workers))
+    argument_parser.add_argument(
+        "--cache_dir",
+        dest="cache_dir",
+        default=default_cache_dir,
+        help="Directory for cached pages, revalidated on each run e.g. " +
+             default_cache_dir)
+    args = argument_parser.parse_args()
+
+    # cache for conditional requests
+    if not os.path.exists(args.cache_dir):
+        os.makedirs(args.cache_dir)
+
+    # open connection pool, workers share a fixed set of pooled connections
+    pool_manager = urllib3.PoolManager(
+        num_pools=1,
+        maxsize=args.max_workers,
+        block=True,
+        retries=Retry(
+            total=default_nb_retries,
+            backoff_factor=default_retry_backoff,
+            status_forcelist=retry_status_codes),
+        headers={"Connection": "keep-alive",
+                 "Accept-Encoding": "gzip, deflate"})
+
+    # get datasets listed on website
+    datasets = get_dataset_ids(pool_manager, args.cache_dir)
 
-    # parse response text
-    text_locations = [text_location.end()
-                      for text_location in re.finditer(datasets_url, text)]
-    datasets = [str(text[text_location:text_location + 19])
-                for text_location in text_locations]
+    # get sensor types for each dataset
+    sensor_types = fetch_all_sensor_types(
+        pool_manager, datasets, args.cache_dir, args.max_workers)
 
-    # ignore metadata and sort unique datasets
-    datasets = datasets[2:]
-    datasets = sorted(list(set(datasets)))
+    # one entry per dataset, in sorted order
+    lines = [dataset + "," + ",".join(sensor_types[dataset]) + "\n"
+             for dataset in datasets]
 
     # write output text file
     datasets_file = "datasets.csv"
     with open(datasets_file, "w") as file_handle:
-        # iterate datasets
-        for dataset in datasets:
-            # url to dataset page
-            dataset_url = datasets_url + dataset
-            result = session_requests.get(dataset_url)
-            text = result.text
-
-            # parse text for sensor type
-            start = [
-                text_location.end() for text_location in re.finditer(
-                    "download/\?filename=datasets", text)]
-            sensor_types = []
-            for s in start:
-                ss = s
-                while text[ss + 40:ss + 44] != ".tar":
-                    ss += 1
-                sensor_type = text[s + 41:ss + 40]
-                sensor_types.append(str(sensor_type))
-
-            # write dataset entry
-            file_handle.write(dataset + "," + ",".join(sensor_types) + "\n")
+        file_handle.writelines(lines)
 
 
 if __name__ == "__main__":
@@ -9,39 +9,82 @@ Oxford Robotics Institute, Oxford University.
 
 # imports
 import argparse
-import datetime
-from lxml import html
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import csv
+import fnmatch
 import os
+import re
 import requests
+from requests.adapters import HTTPAdapter
+import shutil
 import tarfile
+import threading
 import time
 from tqdm import tqdm
-import math
+import urllib3
+from urllib3.util.retry import Retry
 
 # urls
 login_url = "https://mrgdatashare.robots.ox.ac.uk/"
 datasets_url = "https://robotcar-dataset.robots.ox.ac.uk/datasets/"
 base_download_url = "http://mrgdatashare.robots.ox.ac.uk:80/download/?filename=datasets/"
 
+# requests
+user_agent = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.87 Safari/537.36'
+
 # responses
 good_status_code = 200
+partial_status_code = 206
+range_not_satisfiable_status_code = 416
 failed_login = "Please try again or email for support"
+file_not_found = b"File not found."
+probe_range = "bytes=0-63"
+
+# parsing - authentication token in the login form, whatever the attribute order
+csrf_middleware_token_regex = re.compile(
+    rb"<input(?=[^>]*\bname=[\"']csrfmiddlewaretoken[\"'])"
+    rb"[^>]*\bvalue=[\"']([^\"']+)")
 
 # filesystem
 file_extension = ".tar"
+partial_file_extension = ".part"
+done_file_extension = ".done"
+bad_file_extension = ".bad"
+tar_buffer_length = 1024 * 1024
 downloads_dir_example = os.path.expanduser("~/Downloads")
 
-# throttle params (seconds) - to avoid overloading the server with requests and to avoid getting blocked by the server for too many requests in a short time period
+# network params (bytes) - size of reads from the connection, independent of the throttle's chunk length
+default_network_chunk_length = 1024 * 1024
+
+# parallel params - large sensor logs may be split over several connections (bytes)
+default_parallel_streams = 1
+parallel_min_length = 64 * 1024 * 1024
+
+# throttle params (seconds) - to avoid overloading the server with requests and to avoid getting blocked by the server for too many requests in a short time period,
+# off unless a number of chunks per period is given
 default_period_duration = 10 * 60
-default_chunks_per_period = 1000
-default_chunk_length = 1 * 1024
+default_chunks_per_period = 0
+default_chunk_length = 256 * 1024
+count_length = 1024 * 1024
 
 # download errors handling params (seconds) - to avoid overloading the server and to avoid losing data due to network errors  
 default_relogin_duration = 10 * 60
+relogin_backoff = 2
 default_nb_tries_reconnection = 5
 default_reconnection_duration = 10 * 60
 default_choice_sensors = 'all'
 default_choice_runs_file = 'all'
+default_choice_members = 'all'
+
+# retry params (seconds) - transient server errors are retried with backoff on a pooled keep-alive connection
+default_nb_retries = 5
+default_retry_backoff = 0.5
+retry_status_codes = [429, 500, 502, 503, 504]
+
+# concurrency params - number of sensor logs downloaded and unzipped at once
+default_max_workers = 8
+default_max_unzip_workers = 1
 
 
 class Datasets:
@@ -109,21 +152,22 @@ class Datasets:
             choice_runs = 'all'
         else:
             with open(choice_runs_file, 'r') as f:
-                choice_runs = f.read().splitlines()
-        with open(datasets_file, "r") as file_handle:
-            lines = file_handle.readlines()
-            for line in lines:
-                line = line.strip("\n").split(",")
-                if choice_runs == 'all' or line[0] in choice_runs: # choose this run
+                choice_runs = frozenset(f.read().split())
+        # one scan per sensor type for whichever choice appears in it
+        choice_sensors_regex = re.compile(
+            "|".join(re.escape(choice_sensor) for choice_sensor in choice_sensors))
+        with open(datasets_file, "r", newline="") as file_handle:
+            for row in csv.reader(file_handle):
+                if not row:
+                    continue
+                if choice_runs == 'all' or row[0] in choice_runs: # choose this run
                     if choice_sensors[0] == 'all':
-                        dataset = {"dataset": line[0], "file_patterns": line[1:]}
+                        dataset = {"dataset": row[0], "file_patterns": row[1:]}
                     else: # not all sensors
-                        exist_sensors = [] # sensors that will be downloaded
-                        for exist_sensor in line[1:]: # enumerate exist_sensor in this run
-                            for choice_sensor in choice_sensors: # enumerate choice_sensor the user want to download
-                                if choice_sensor in exist_sensor: # if choice_sensor is in exist_sensor
-                                    exist_sensors.append(exist_sensor) # add exist_sensor to exist_sensors
-                        dataset = {"dataset": line[0], "file_patterns": exist_sensors}
+                        # sensors that will be downloaded, each once even if several choices match it
+                        exist_sensors = [exist_sensor for exist_sensor in row[1:]
+                                         if choice_sensors_regex.search(exist_sensor)]
+                        dataset = {"dataset": row[0], "file_patterns": exist_sensors}
                     datasets.append(dataset)
 
         print("got num_datasets: " + str(len(datasets)))
@@ -137,6 +181,12 @@ class Scraper:
                 username (string): RCD login username.
                 password (string): RCD login password.
                 session_requests (requests.Session): Persistent login session.
+                network_chunk_length (int): Size of reads from the connection in bytes.
+                parallel_streams (int): Number of connections to split a large sensor log over.
+                quiet (bool): Whether to hide download progress bars.
+                num_logins (int): Number of logins so far in this session.
+                num_relogins (int): Logins since a sensor log was last served rather than html.
+                login_lock (threading.Lock): Lets one worker at a time log in again.
     """
 
     def __init__(self, parse_args):
@@ -151,12 +201,39 @@ class Scraper:
         self.username = Scraper.get_username(parse_args)
         self.password = Scraper.get_password(parse_args)
 
-        # persistent login session
+        # persistent login session, pooling a keep-alive connection per worker
         self.session_requests = requests.session()
+        adapter = HTTPAdapter(
+            pool_connections=2,
+            pool_maxsize=parse_args.max_workers * parse_args.parallel_streams,
+            max_retries=Retry(
+                total=default_nb_retries,
+                backoff_factor=default_retry_backoff,
+                status_forcelist=retry_status_codes,
+                allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"}))
+        self.session_requests.mount("http://", adapter)
+        self.session_requests.mount("https://", adapter)
+        self.session_requests.headers.update(
+            {"User-Agent": user_agent, "Connection": "keep-alive"})
+
+        # size of reads from the connection
+        self.network_chunk_length = parse_args.network_chunk_length
+
+        # connections per large sensor log
+        self.parallel_streams = parse_args.parallel_streams
+
+        # console
+        self.quiet = parse_args.quiet
 
         # errors handling
         self.relogin_duration = parse_args.relogin_duration
 
+        # workers finding the session expired log in again once between them,
+        # backing off while the server keeps answering with html
+        self.num_logins = 0
+        self.num_relogins = 0
+        self.login_lock = threading.Lock()
+
     @staticmethod
     def get_username(parse_args):
         """Retrieves account details from CL.
@@ -208,6 +285,7 @@ class Scraper:
 
         # perform login
         self.post(payload)
+        self.num_logins = self.num_logins + 1
 
     def get_csrf_middleware_token(self):
         """Retrieve authentication token from login session cookies.
@@ -215,15 +293,19 @@ class Scraper:
         Returns:
             string: Authentication token from cookies.
 
+        Raises:
+            ValueError: If the login page has no authentication token.
+
         """
 
         # load cookies
         result = self.session_requests.get(login_url)
-        tree = html.fromstring(result.text)
 
         # get authentication token
-        csrf_middleware_token = list(
-            set(tree.xpath("//input[@name='csrfmiddlewaretoken']/@value")))[0]
+        match = csrf_middleware_token_regex.search(result.content)
+        if not match:
+            raise ValueError("Login failed, no csrfmiddlewaretoken found.")
+        csrf_middleware_token = match.group(1).decode("ascii")
         print("got csrf_middleware_token: " + csrf_middleware_token)
 
         return csrf_middleware_token
@@ -271,57 +353,358 @@ class Scraper:
 
         print("Logged in!")
 
-    def scrape(self, url_handler):
-        """Downloads a sensor log from a particular dataset.
+    def get_file(self, url_handler, offset=0, end=None):
+        """Requests a sensor log, logging in again if the session has expired.
 
         Args:
             url_handler (URLHandler): Local file path for the sensor log to be downloaded.
+            offset (int): Position in the sensor log to request it from.
+            end (int): Byte after the last byte to request, or None for the rest.
+
+        Returns:
+            requests.Response: Streamed response for the sensor log.
+
+        Raises:
+            ValueError: If the sensor log could not be requested.
 
         """
 
-        # make request
+        # make request, for the rest of the sensor log if resuming or for
+        # one slice of it
         print("requesting file_url: " + url_handler.file_url)
-        result = self.session_requests.get(url_handler.file_url, stream=True)
-        if result.status_code != good_status_code:
+        num_logins = self.num_logins
+        headers = None
+        if offset or end is not None:
+            headers = {"Range": "bytes=" + str(offset) + "-" +
+                                ("" if end is None else str(end - 1))}
+        result = self.session_requests.get(
+            url_handler.file_url, headers=headers, stream=True)
+        if result.status_code not in (good_status_code,
+                                      partial_status_code,
+                                      range_not_satisfiable_status_code):
             raise ValueError(
                 "bad file_url: " +
                 url_handler.file_url)
 
+        # nothing left from this offset, the caller starts over
+        if result.status_code == range_not_satisfiable_status_code:
+            return result
+
         while 'html' in result.headers.get('content-type', 'html'):
-            print(
-                "Got html file as result. Wait {self.relogin_duration} seconds and re-loging...")
-            time.sleep(self.relogin_duration)
-            self.login()
+            result.close()
+
+            # log in again unless another worker already has since this request,
+            # at once for an expired session then backing off up to the full wait
+            with self.login_lock:
+                if self.num_logins == num_logins:
+                    relogin_seconds = 0
+                    if self.num_relogins:
+                        relogin_seconds = min(
+                            self.relogin_duration,
+                            relogin_backoff * 2 ** (self.num_relogins - 1))
+                    print(
+                        "Got html file as result. Wait " +
+                        str(relogin_seconds) +
+                        " seconds and re-loging...")
+                    time.sleep(relogin_seconds)
+                    self.login()
+                    self.num_relogins = self.num_relogins + 1
+                num_logins = self.num_logins
+
             result = self.session_requests.get(
-                url_handler.file_url, stream=True)
+                url_handler.file_url, headers=headers, stream=True)
+
+        # session works again, the next expiry is logged in again at once
+        if self.num_relogins:
+            with self.login_lock:
+                self.num_relogins = 0
+
+        # body is read from the raw stream
+        result.raw.decode_content = True
+
+        return result
+
+    def probe(self, url_handler):
+        """Checks whether the server has a sensor log from its first bytes.
+
+        Args:
+            url_handler (URLHandler): Local file path for the sensor log to be downloaded.
+
+        Returns:
+            bool: Whether the sensor log was found, True if unsure.
+
+        """
+
+        result = self.session_requests.get(
+            url_handler.file_url, headers={"Range": probe_range}, stream=True)
+        try:
+            # expired session or error, leave it to the download to handle
+            if 'html' in result.headers.get('content-type', 'html'):
+                return True
+
+            # bad url/no match for sensor, the message is the whole body
+            result.raw.decode_content = True
+            file_was_found = not result.raw.read(
+                len(file_not_found)).startswith(file_not_found)
+
+            # read the rest of a ranged body, a few bytes at most, so that the
+            # connection goes back to the pool rather than being dropped
+            if result.status_code == partial_status_code:
+                result.raw.read()
+
+            return file_was_found
+        finally:
+            # a whole sensor log if the range was ignored, not needed
+            result.close()
+
+    def scrape(self, url_handler):
+        """Downloads a sensor log from a particular dataset.
+
+        Args:
+            url_handler (URLHandler): Local file path for the sensor log to be downloaded.
+
+        Returns:
+            bool: Whether the sensor log was found.
+
+        """
+
+        # large sensor log, split over several connections
+        if self.parallel_streams > 1:
+            total_size = self.get_total_size(url_handler)
+            if total_size >= parallel_min_length:
+                return self.scrape_parallel(url_handler, total_size)
+
+        # resume a partial download left by an earlier try or run
+        partial_file_path = url_handler.partial_file_path
+        offset = 0
+        if os.path.exists(partial_file_path):
+            offset = os.path.getsize(partial_file_path)
+        result = self.get_file(url_handler, offset)
+
+        # nothing left to resume, e.g. space reserved by an interrupted run
+        if result.status_code == range_not_satisfiable_status_code:
+            result.close()
+            offset = 0
+            result = self.get_file(url_handler)
+
+        # release the connection however the download ends
+        with result:
+            # bad url/no match for sensor, the message starts the body
+            first_block = result.raw.read(self.network_chunk_length)
+            if first_block.startswith(file_not_found):
+                return False
+
+            # range ignored, start over
+            if result.status_code != partial_status_code:
+                offset = 0
+            # range sent from elsewhere, would corrupt the file, so start
+            # over on the next try
+            elif not result.headers.get('content-range', '').startswith(
+                    "bytes " + str(offset) + "-"):
+                os.remove(partial_file_path)
+                raise urllib3.exceptions.ProtocolError(
+                    "bad content range for file_url: " +
+                    url_handler.file_url)
+
+            # open local file
+            print(
+                "downloading local_file_path: " +
+                url_handler.local_file_path +
+                ", from offset: " + str(offset))
+
+            # buffered so small reads from the connection are written in large blocks
+            with open(partial_file_path, 'r+b' if offset else 'wb',
+                      buffering=tar_buffer_length) as file_handle:
+                file_handle.seek(offset)
+
+                # reserve the whole file up front so it is laid out contiguously
+                remaining_size = int(result.headers.get('content-length', 0))
+                total_size = offset + remaining_size
+                if remaining_size and hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(file_handle.fileno(), 0, total_size)
+
+                # copy body in large blocks, counting bytes as they are written
+                try:
+                    with tqdm(total=total_size or None,
+                              initial=offset,
+                              unit='B',
+                              unit_scale=True,
+                              unit_divisor=1024,
+                              disable=self.quiet) as progress_bar:
+                        throttled_file = ThrottledFile(
+                            file_handle, throttle, progress_bar)
+                        throttled_file.write(first_block)
+                        shutil.copyfileobj(
+                            result.raw, throttled_file, self.network_chunk_length)
+                        throttled_file.flush()
+
+                    # body ended early, resume from what was written on the next try
+                    if remaining_size and file_handle.tell() != total_size and \
+                            'content-encoding' not in result.headers:
+                        raise urllib3.exceptions.ProtocolError(
+                            "short body for file_url: " +
+                            url_handler.file_url)
+                finally:
+                    # drop any reserved space that was not written, so that
+                    # the size is where to resume from
+                    file_handle.truncate()
+
+        # complete
+        os.replace(partial_file_path, url_handler.local_file_path)
+
+        return True
+
+    def get_total_size(self, url_handler):
+        """Gets the size of a sensor log, if the server serves it in ranges.
+
+        Args:
+            url_handler (URLHandler): Local file path for the sensor log to be downloaded.
+
+        Returns:
+            int: Size of the sensor log in bytes, 0 if ranges are not served.
+
+        """
+
+        with self.session_requests.get(
+                url_handler.file_url, headers={"Range": "bytes=0-0"},
+                stream=True) as result:
+            # ranges not served, or an error or login page
+            content_range = result.headers.get('content-range', '')
+            if result.status_code != partial_status_code or '/' not in content_range:
+                return 0
+
+            # read the one byte body, so that the connection goes back to the
+            # pool rather than being dropped
+            result.raw.read()
+
+            # e.g. bytes 0-0/1234
+            total_size = content_range.rsplit('/', 1)[1]
+            return int(total_size) if total_size.isdigit() else 0
+
+    def scrape_parallel(self, url_handler, total_size):
+        """Downloads a sensor log as byte ranges over several connections.
+
+        Args:
+            url_handler (URLHandler): Local file path for the sensor log to be downloaded.
+            total_size (int): Size of the sensor log in bytes.
+
+        Returns:
+            bool: Whether the sensor log was found.
+
+        """
 
-        # open local file
         print(
             "downloading local_file_path: " +
-            url_handler.local_file_path)
+            url_handler.local_file_path +
+            ", over parallel_streams: " + str(self.parallel_streams))
+
+        # a fresh file, slices are written in place
+        try:
+            with open(url_handler.partial_file_path, 'wb') as file_handle:
+                if hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(file_handle.fileno(), 0, total_size)
+                else:
+                    file_handle.truncate(total_size)
+
+                # one slice per connection
+                boundaries = [i * total_size // self.parallel_streams
+                              for i in range(self.parallel_streams + 1)]
+                with tqdm(total=total_size,
+                          unit='B',
+                          unit_scale=True,
+                          unit_divisor=1024,
+                          disable=self.quiet) as progress_bar, \
+                        ThreadPoolExecutor(max_workers=self.parallel_streams) as executor:
+                    futures = [executor.submit(self.scrape_range, url_handler,
+                                               file_handle.fileno(), start, end,
+                                               progress_bar)
+                               for start, end in zip(boundaries[:-1], boundaries[1:])]
+                    for future in futures:
+                        future.result()
+        except BaseException:
+            # slices are not resumed, start over on the next try
+            if os.path.exists(url_handler.partial_file_path):
+                os.remove(url_handler.partial_file_path)
+            raise
+
+        # complete
+        os.replace(url_handler.partial_file_path, url_handler.local_file_path)
+
+        return True
+
+    def scrape_range(self, url_handler, file_descriptor, start, end,
+                     progress_bar):
+        """Downloads one byte range of a sensor log into its place in the file.
+
+        Args:
+            url_handler (URLHandler): Local file path for the sensor log to be downloaded.
+            file_descriptor (int): Local file to write to.
+            start (int): First byte of the range.
+            end (int): Byte after the last byte of the range.
+            progress_bar (tqdm): Download progress in bytes.
+
+        Raises:
+            urllib3.exceptions.ProtocolError: If the server did not send the range.
+
+        """
+
+        # logging in again if the session has expired
+        with self.get_file(url_handler, start, end) as result:
+            if result.status_code != partial_status_code or \
+                    not result.headers.get('content-range', '').startswith(
+                        "bytes " + str(start) + "-"):
+                raise urllib3.exceptions.ProtocolError(
+                    "bad range for file_url: " +
+                    url_handler.file_url)
+
+            # write blocks at their offset, counting bytes as they are read
+            throttled_file = ThrottledFile(result.raw, throttle, progress_bar)
+            offset = start
+            for block in iter(
+                    lambda: throttled_file.read(self.network_chunk_length), b""):
+                # a write may be short, carry on from where it stopped
+                block = memoryview(block)
+                while block:
+                    num_written = os.pwrite(file_descriptor, block, offset)
+                    block = block[num_written:]
+                    offset = offset + num_written
+            throttled_file.flush()
+
+        if offset != end:
+            raise urllib3.exceptions.ProtocolError(
+                "short range for file_url: " +
+                url_handler.file_url)
+
+    def scrape_and_extract(self, url_handler, zipper):
+        """Downloads a sensor log and extracts it while it arrives.
+
+        Args:
+            url_handler (URLHandler): Local file path for the sensor log to be downloaded.
+            zipper (Zipper): Archiver for the sensor log's dataset.
+
+        Returns:
+            bool: Whether the sensor log was found.
 
-        agent = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.87 Safari/537.36'
-        result.headers.update({'user-agent': agent})
+        """
 
-        with open(url_handler.local_file_path, 'wb') as file_handle:
+        # release the connection however the download ends
+        with self.get_file(url_handler) as result:
+            # bad url/no match for sensor, the message starts the body
+            first_block = result.raw.read(self.network_chunk_length)
+            if first_block.startswith(file_not_found):
+                return False
 
-            # iterate chunks
+            # extract body as it is read, counting bytes as they are read
             total_size = int(result.headers.get('content-length', 0))
-            for chunk in tqdm(result.iter_content(
-                    chunk_size=throttle.chunk_length),
-                    total=math.ceil(total_size // int(throttle.chunk_length)),
-                    unit='KB',
-                    unit_scale=True):
-                # bad url/no match for sensor
-                if b"File not found." in chunk:
-                    return False
-
-                # count recent chunks
-                throttle.count()
-
-                # filter out keep-alive new chunks
-                if chunk:
-                    file_handle.write(chunk)
+            with tqdm(total=total_size or None,
+                      unit='B',
+                      unit_scale=True,
+                      unit_divisor=1024,
+                      disable=self.quiet) as progress_bar:
+                throttled_file = ThrottledFile(
+                    result.raw, throttle, progress_bar, first_block)
+                zipper.unzip_stream(throttled_file, url_handler)
+                throttled_file.flush()
 
         return True
 
@@ -332,9 +715,12 @@ class Throttle:
             Attributes:
                 period_duration (int): Top limit for duration of download window.
                 chunk_length (int): Top limit for size of chunks in bytes.
-                chunks_per_period (int): Top limit for chunks downloaded in one period.
-                num_chunks_in_period (int): Chunks downloaded in this period.
-                period (datetime.datetime): Timestamp.
+                chunks_per_period (int): Top limit for chunks downloaded in one period, 0 for no limit.
+                bytes_per_period (int): Top limit for bytes downloaded in one period.
+                rate (float): Bytes allowed per second, on average.
+                tokens (float): Bytes that can be downloaded without waiting, negative while workers wait.
+                last_refill (float): Monotonic timestamp of the last refill of tokens.
+                lock (threading.Lock): Guards counters shared by download workers.
     """
 
     def __init__(self, parse_args):
@@ -355,9 +741,16 @@ class Throttle:
         self.chunks_per_period = Throttle.get_chunks_per_period(
             parse_args)
 
-        # reset counters
-        self.num_chunks_in_period = 0
-        self.period = datetime.datetime.now()
+        # limit in bytes, whatever size the reads happen to be
+        self.bytes_per_period = self.chunks_per_period * self.chunk_length
+
+        # token bucket, starting full, refilled continuously over the period
+        self.rate = self.bytes_per_period / self.period_duration
+        self.tokens = float(self.bytes_per_period)
+        self.last_refill = time.monotonic()
+
+        # counters are shared by download workers
+        self.lock = threading.Lock()
 
     @staticmethod
     def get_period_duration(parse_args):
@@ -405,74 +798,139 @@ class Throttle:
             parse_args (list): List of input CL arguments.
 
         Returns:
-            string: Throttle.
+            string: Throttle, 0 for no limit.
 
         Raises:
-            IOError: If throttle was not provided on the CL.
+            IOError: If throttle provided on the CL is negative.
 
         """
 
-        if not parse_args.chunks_per_period:
-            raise IOError("Please specify option chunks_per_period.")
+        if parse_args.chunks_per_period < 0:
+            raise IOError("Please specify a non-negative option chunks_per_period.")
         return parse_args.chunks_per_period
 
-    def reset(self):
-        """Resets throttle counters.
+    def acquire(self, num_bytes):
+        """Takes bytes from the bucket, idling until enough have refilled.
+
+        Args:
+            num_bytes (int): Number of bytes retrieved.
 
         """
 
-        print("resetting period throttle...")
-        self.num_chunks_in_period = 0
-        self.period = datetime.datetime.now()
+        # no limit
+        if not self.rate:
+            return
+
+        # reserve the bytes, going into debt if the bucket is short, so that
+        # waiting workers each sleep for their own place in line
+        with self.lock:
+            # refill for the time since the last call, up to one period's worth
+            now = time.monotonic()
+            self.tokens = min(
+                self.bytes_per_period,
+                self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.tokens = self.tokens - num_bytes
+
+            # within limit
+            if self.tokens >= 0:
+                return
 
-    def wait(self):
-        """Forces the downloader to obey throttle limit by idling.
+            # needs to wait for the debt to be repaid
+            seconds = -self.tokens / self.rate
+
+        print(
+            "waiting for throttle for seconds: " +
+            str(round(seconds, 1)) +
+            "...")
+        time.sleep(seconds)
+
+
+class ThrottledFile:
+    """Wraps a file so that bytes passing through count against the throttle.
+
+            Attributes:
+                file_handle (file): File being read or written.
+                throttle (Throttle): Download throttle.
+                progress_bar (tqdm): Download progress in bytes.
+                unread (bytes): Data already taken from the file, read first.
+                num_bytes (int): Bytes passed through but not yet counted.
+    """
+
+    def __init__(self, file_handle, throttle, progress_bar, unread=b""):
+        """Initialises the byte count for this file.
+
+        Args:
+            file_handle (file): File being read or written.
+            throttle (Throttle): Download throttle.
+            progress_bar (tqdm): Download progress in bytes.
+            unread (bytes): Data already taken from the file, read first.
 
         """
 
-        # reset period count
-        period_seconds = self.get_period_seconds()
+        self.file_handle = file_handle
+        self.throttle = throttle
+        self.progress_bar = progress_bar
+        self.unread = unread
+        self.num_bytes = 0
 
-        # needs reset
-        if period_seconds < 0:
-            self.reset()
-        # needs to pause
-        elif self.num_chunks_in_period > self.chunks_per_period:
-            Throttle.pause(period_seconds)
+    def read(self, size=-1):
+        """Reads data and counts it against the throttle.
 
-    def get_period_seconds(self):
-        """Computes the time remaining in this throttle window.
+        Args:
+            size (int): Maximum number of bytes to read, all if negative.
 
         Returns:
-            int: Time remaining in this throttle window.
+            bytes: Data read.
 
         """
 
-        period_seconds = self.period_duration - \
-            (datetime.datetime.now() - self.period).seconds
-        # console
-        print("num_chunks_in_period: " + str(self.num_chunks_in_period) +
-              ", period_seconds: " + str(period_seconds))
-        return period_seconds
+        # hand back data already taken from the file first
+        if self.unread:
+            if size < 0:
+                size = len(self.unread)
+            data = self.unread[:size]
+            self.unread = self.unread[size:]
+        else:
+            data = self.file_handle.read(size)
 
-    @staticmethod
-    def pause(period_seconds):
-        """Idles.
+        self.add(len(data))
+        return data
+
+    def write(self, data):
+        """Writes data and counts it against the throttle.
+
+        Args:
+            data (bytes): Data to write.
 
         """
 
-        print(
-            "pausing for throttle for period_seconds: " +
-            str(period_seconds) +
-            "...")
-        time.sleep(period_seconds)
+        self.file_handle.write(data)
+        self.add(len(data))
+
+    def add(self, num_bytes):
+        """Counts bytes passed through against the throttle.
 
-    def count(self):
-        """Increments the number of chunks retrieved in this throttle window.
+        Args:
+            num_bytes (int): Number of bytes passed through.
 
         """
 
-        self.num_chunks_in_period = self.num_chunks_in_period + 1
+        self.progress_bar.update(num_bytes)
+
+        # count recent bytes against the shared throttle in batches
+        self.num_bytes = self.num_bytes + num_bytes
+        if self.num_bytes >= count_length:
+            self.flush()
+
+    def flush(self):
+        """Counts bytes passed through so far against the throttle.
+
+        """
+
+        if self.num_bytes:
+            self.throttle.acquire(self.num_bytes)
+            self.num_bytes = 0
 
 
 class DatasetHandler:
@@ -481,10 +939,13 @@ class DatasetHandler:
             Attributes:
                 downloads_dir (string): Root download directory.
                 dataset (string): Dataset to download.
-                dataset_dir (string): Dataset's download directory.
-                tar_dir (string): Extraction directory.
+                url_prefix (string): URL target path shared by this dataset's sensor logs.
+                local_prefix (string): Local file system path shared by this dataset's sensor logs.
     """
 
+    # one per dataset, no per-instance dict needed
+    __slots__ = ("downloads_dir", "dataset", "url_prefix", "local_prefix")
+
     def __init__(self, parse_args, dataset):
         """Initialises local file paths for downloads concerning this dataset.
 
@@ -494,12 +955,16 @@ class DatasetHandler:
 
         """
 
-        # root download dir
-        self.downloads_dir = DatasetHandler.get_downloads_dir(parse_args)
+        # root download dir, already resolved when parsing the CL
+        self.downloads_dir = parse_args.downloads_dir
 
         # dataset to download
         self.dataset = dataset
 
+        # paths shared by every sensor log in this dataset
+        self.url_prefix = base_download_url + dataset + "/" + dataset + "_"
+        self.local_prefix = os.path.join(self.downloads_dir, dataset + "_")
+
     @staticmethod
     def get_downloads_dir(parse_args):
         """Gets the root download directory from the CL.
@@ -517,7 +982,7 @@ class DatasetHandler:
 
         if not parse_args.downloads_dir:
             raise IOError("Please specify option downloads_dir.")
-        return os.path.abspath(parse_args.downloads_dir)
+        return os.path.abspath(os.path.expanduser(parse_args.downloads_dir))
 
 
 class Zipper:
@@ -525,20 +990,27 @@ class Zipper:
 
             Attributes:
                 dataset_handler (DatasetHandler): Local file paths for this dataset to be downloaded.
+                choice_members (list): Patterns of archive members to extract, or ['all'].
                 num_successful_unzipped (int): Number of successful archiving operations.
+                lock (threading.Lock): Guards counters shared by download workers.
     """
 
-    def __init__(self, dataset_handler):
+    def __init__(self, parse_args, dataset_handler):
         """Initialises an archiver for this downloaded dataset.
 
         Args:
+            parse_args (list): List of input CL arguments.
             dataset_handler (DatasetHandler): Local file paths for this dataset to be downloaded.
 
         """
 
         self.dataset_handler = dataset_handler
+        self.choice_members = parse_args.choice_members.split(',')
         self.num_successful_unzipped = 0
 
+        # archives of one dataset may be extracted by several workers
+        self.lock = threading.Lock()
+
     # unzip
     def unzip(self, url_handler):
         """Extracts archive contents.
@@ -550,24 +1022,156 @@ class Zipper:
 
         print("unzipping local_file_path: " + url_handler.local_file_path)
         try:
-            # open tar
-            tar = tarfile.open(url_handler.local_file_path, "r:")
+            # open tar, read once front to back rather than indexed first,
+            # unless only some members are wanted and the rest can be skipped
+            mode = "r|" if self.choice_members[0] == 'all' else "r:"
+            with open(url_handler.local_file_path, "rb",
+                      buffering=tar_buffer_length) as file_handle:
+                # read front to back, so let the kernel read further ahead
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(file_handle.fileno(), 0, 0,
+                                     os.POSIX_FADV_SEQUENTIAL)
 
-            # do extraction
-            tar.extractall(path=self.dataset_handler.downloads_dir)
+                tar = tarfile.open(fileobj=file_handle, mode=mode)
 
-            # close tar file
-            tar.close()
+                # do extraction
+                self.extract(tar)
+
+                # close tar file
+                tar.close()
+
+            # mark sensor log as done for later runs
+            self.mark_done(url_handler)
 
             # keep track of successful archives
-            self.num_successful_unzipped = self.num_successful_unzipped + 1
+            with self.lock:
+                self.num_successful_unzipped = self.num_successful_unzipped + 1
+
+            # clear tar
+            os.remove(url_handler.local_file_path)
         except tarfile.ReadError:
+            # keep tar for inspection, out of the way so that a later run
+            # downloads it again
+            os.replace(url_handler.local_file_path, url_handler.bad_file_path)
             print(
                 "failed when unzipping local_file_path: " +
-                url_handler.local_file_path)
+                url_handler.local_file_path +
+                ", kept as: " + url_handler.bad_file_path)
+
+    def unzip_stream(self, file_handle, url_handler):
+        """Extracts archive contents as they are read, without seeking.
+
+        Args:
+            file_handle (file): Stream of the archive.
+            url_handler (URLHandler): Local file path for the sensor log to be downloaded.
+
+        """
+
+        print("unzipping file_url: " + url_handler.file_url)
+        try:
+            # open tar stream
+            tar = tarfile.open(fileobj=file_handle, mode="r|")
+
+            # do extraction
+            self.extract(tar)
+
+            # close tar stream
+            tar.close()
+
+            # mark sensor log as done for later runs
+            self.mark_done(url_handler)
+
+            # keep track of successful archives
+            with self.lock:
+                self.num_successful_unzipped = self.num_successful_unzipped + 1
+        except tarfile.ReadError:
+            print("failed when unzipping file_url: " + url_handler.file_url)
+
+    def get_done_members(self, url_handler):
+        """Gets the member patterns earlier runs extracted a sensor log with.
+
+        Args:
+            url_handler (URLHandler): Local file path for the sensor log to be downloaded.
+
+        Returns:
+            list: Patterns of extracted members, ['all'] for whole archives, or None if not extracted.
+
+        """
+
+        if not os.path.exists(url_handler.done_file_path):
+            return None
+
+        # markers from before members were recorded are for whole archives
+        with open(url_handler.done_file_path, "r") as file_handle:
+            done_members = file_handle.read().split(',')
+        if done_members == ['']:
+            return ['all']
+        return done_members
+
+    def mark_done(self, url_handler):
+        """Marks a sensor log as extracted, recording which members were chosen.
+
+        Args:
+            url_handler (URLHandler): Local file path for the sensor log to be downloaded.
+
+        """
+
+        # members extracted by earlier runs are still on disk, keep them
+        done_members = self.get_done_members(url_handler)
+        if done_members is None or self.choice_members[0] == 'all':
+            done_members = self.choice_members
+        elif done_members[0] != 'all':
+            done_members = done_members + [
+                choice_member for choice_member in self.choice_members
+                if choice_member not in done_members]
+
+        with open(url_handler.done_file_path, "w") as file_handle:
+            file_handle.write(",".join(done_members))
 
-        # clear tar
-        os.remove(url_handler.local_file_path)
+    def is_done(self, url_handler):
+        """Checks whether earlier runs extracted the members chosen now.
+
+        Args:
+            url_handler (URLHandler): Local file path for the sensor log to be downloaded.
+
+        Returns:
+            bool: Whether the sensor log can be skipped.
+
+        """
+
+        done_members = self.get_done_members(url_handler)
+        if done_members is None:
+            return False
+        if done_members[0] == 'all':
+            return True
+
+        # some members only, enough if they cover this run's choice
+        return self.choice_members[0] != 'all' and \
+            set(self.choice_members) <= set(done_members)
+
+    def extract(self, tar):
+        """Extracts chosen members of an open archive into the download directory.
+
+        Args:
+            tar (tarfile.TarFile): Archive to extract.
+
+        """
+
+        # choose members, in archive order so that streams are not rewound
+        members = None
+        if self.choice_members[0] != 'all':
+            members = (member for member in tar
+                       if any(fnmatch.fnmatch(member.name, choice_member)
+                              for choice_member in self.choice_members))
+
+        # plain files and directories only, skipping ownership changes
+        if hasattr(tarfile, "data_filter"):
+            tar.extractall(
+                path=self.dataset_handler.downloads_dir, members=members,
+                filter="data")
+        else:
+            tar.extractall(
+                path=self.dataset_handler.downloads_dir, members=members)
 
     def tidy_up(self):
         """Tidies up dataset's download directory.
@@ -585,8 +1189,15 @@ class URLHandler:
                 file_pattern (string): Sensor type / file stub.
                 file_url (string): URL target path.
                 local_file_path (string): Local file system destination path.
+                partial_file_path (string): Local file system path while downloading.
+                done_file_path (string): Local file system path marking a successful extraction.
+                bad_file_path (string): Local file system path of a tar that failed to extract.
     """
 
+    # one per sensor log, no per-instance dict needed
+    __slots__ = ("file_pattern", "file_url", "local_file_path",
+                 "partial_file_path", "done_file_path", "bad_file_path")
+
     def __init__(self, dataset_handler, file_pattern):
         """Initialises the download of one file type for this dataset.
 
@@ -605,7 +1216,16 @@ class URLHandler:
 
         # path to save to disk
         self.local_file_path = URLHandler.get_local_file_path(
-            self.file_url, dataset_handler)
+            self.file_pattern, dataset_handler)
+
+        # path to save to disk until the download is complete
+        self.partial_file_path = self.local_file_path + partial_file_extension
+
+        # path marking the sensor log as extracted
+        self.done_file_path = self.local_file_path + done_file_extension
+
+        # path a tar that failed to extract is kept at
+        self.bad_file_path = self.local_file_path + bad_file_extension
 
     @staticmethod
     def get_file_url(file_pattern, dataset_handler):
@@ -620,15 +1240,14 @@ class URLHandler:
 
         """
 
-        return base_download_url + dataset_handler.dataset + "/" + \
-            dataset_handler.dataset + "_" + file_pattern + file_extension
+        return dataset_handler.url_prefix + file_pattern + file_extension
 
     @staticmethod
-    def get_local_file_path(file_url, dataset_handler):
+    def get_local_file_path(file_pattern, dataset_handler):
         """Constructs filesystem location for sensor log.
 
         Args:
-            file_url (string): Internet address for the sensor log in this dataset.
+            file_pattern (string): Sensor type to download.
             dataset_handler (DatasetHandler): Local file paths for this dataset to be downloaded.
 
         Returns:
@@ -636,14 +1255,43 @@ class URLHandler:
 
         """
 
-        # get stem from ULR
-        local_file_name = file_url.split('/')[-1]
+        return dataset_handler.local_prefix + file_pattern + file_extension
+
 
-        # extend dataset dir
-        local_file_path = os.path.join(
-            dataset_handler.downloads_dir, local_file_name)
+def download(scraper, zipper, url_handler, parse_args):
+    """Downloads a sensor log, retrying broken connections.
 
-        return local_file_path
+    Args:
+        scraper (Scraper): Logged in session.
+        zipper (Zipper): Archiver for the sensor log's dataset.
+        url_handler (URLHandler): Local file path for the sensor log to be downloaded.
+        parse_args (list): List of input CL arguments.
+
+    Returns:
+        bool: Whether the sensor log was found.
+
+    """
+
+    # perform download
+    file_was_found = False
+    for i in range(parse_args.nb_tries_reconnection):
+        try:
+            if parse_args.stream_extract:
+                file_was_found = scraper.scrape_and_extract(url_handler, zipper)
+            else:
+                file_was_found = scraper.scrape(url_handler)
+            if file_was_found:
+                break
+        except (requests.exceptions.ChunkedEncodingError,
+                urllib3.exceptions.ProtocolError):
+            print(
+                "Connection broken on try " + str(i + 1) + "/" +
+                str(parse_args.nb_tries_reconnection) + ", wait " +
+                str(parse_args.reconnection_duration) +
+                " seconds and restart downloading: " + url_handler.file_url)
+            time.sleep(parse_args.reconnection_duration)
+
+    return file_was_found
 
 
 # main routine
@@ -686,21 +1334,28 @@ if __name__ == "__main__":
         dest="chunk_length",
         type=int,
         default=default_chunk_length,
-        help="Length of download chunks in bytes e.g. " +
+        help="Unit of the throttle limit in bytes, the limit is chunks_per_period * chunk_length bytes per period over all workers, reads from the connection are set by network_chunk_length e.g. " +
              str(default_chunk_length))
+    argument_parser.add_argument(
+        "--network_chunk_length",
+        dest="network_chunk_length",
+        type=int,
+        default=default_network_chunk_length,
+        help="Length of reads from the connection in bytes e.g. " +
+             str(default_network_chunk_length))
     argument_parser.add_argument(
         "--chunks_per_period",
         dest="chunks_per_period",
         type=int,
         default=default_chunks_per_period,
-        help="Maximum number of chunks to download in a throttled download period e.g. " +
+        help="Maximum number of chunks to download in a throttled download period over all workers, if 0 downloads are not throttled e.g. " +
              str(default_chunks_per_period))
     argument_parser.add_argument(
         "--relogin_duration",
         dest="relogin_duration",
         type=int,
         default=default_relogin_duration,
-        help="Number of seconds to wait in case you are disconnected (if you don't use an academic connection) e.g. " +
+        help="Maximum number of seconds to wait in case you are disconnected (if you don't use an academic connection) e.g. " +
              str(default_relogin_duration))
     argument_parser.add_argument(
         "--reconnection_duration",
@@ -716,6 +1371,42 @@ if __name__ == "__main__":
         default=default_nb_tries_reconnection,
         help="Number of downloading tries for a file  e.g. " +
              str(default_nb_tries_reconnection))
+    argument_parser.add_argument(
+        "--max_workers",
+        dest="max_workers",
+        type=int,
+        default=default_max_workers,
+        help="Number of sensor logs to download concurrently e.g. " +
+             str(default_max_workers))
+    argument_parser.add_argument(
+        "--parallel_streams",
+        dest="parallel_streams",
+        type=int,
+        default=default_parallel_streams,
+        help="Number of connections to split each large sensor log over e.g. " +
+             str(default_parallel_streams))
+    argument_parser.add_argument(
+        "--max_unzip_workers",
+        dest="max_unzip_workers",
+        type=int,
+        default=default_max_unzip_workers,
+        help="Number of downloaded sensor logs to unzip concurrently e.g. " +
+             str(default_max_unzip_workers))
+    argument_parser.add_argument(
+        "--stream_extract",
+        dest="stream_extract",
+        action="store_true",
+        help="Extract sensor logs while they download, without saving the tar files")
+    argument_parser.add_argument(
+        "--quiet",
+        dest="quiet",
+        action="store_true",
+        help="Hide download progress bars, keeping one line per sensor log")
+    argument_parser.add_argument(
+        "--overwrite",
+        dest="overwrite",
+        action="store_true",
+        help="Download sensor logs again even if an earlier run extracted them")
     argument_parser.add_argument(
         "--choice_sensors",
         dest="choice_sensors",
@@ -728,6 +1419,12 @@ if __name__ == "__main__":
         type=str,
         default=default_choice_runs_file,
         help="choice of runs recorded in a file to download, if 'all' all runs are downloaded")
+    argument_parser.add_argument(
+        "--choice_members",
+        dest="choice_members",
+        type=str,
+        default=default_choice_members,
+        help="choice of archive members to extract as comma separated patterns, e.g. '*/gps/*', if 'all' all members are extracted e.g. " + default_choice_members)
 
     # parse CL
     args = argument_parser.parse_args()
@@ -735,6 +1432,10 @@ if __name__ == "__main__":
     # set up datasets file
     datasets = Datasets(args).datasets
 
+    # root download dir, resolved once and shared by every dataset
+    args.downloads_dir = DatasetHandler.get_downloads_dir(args)
+    os.makedirs(args.downloads_dir, exist_ok=True)
+
     # persistent login
     scraper = Scraper(args)
 
@@ -744,40 +1445,108 @@ if __name__ == "__main__":
     # start throttle
     throttle = Throttle(args)
 
-    # iterate datasets
-    for dataset in datasets:
-        # apply throttle
-        throttle.wait()
-
-        # dataset handler
-        dataset_handler = DatasetHandler(args, dataset["dataset"])
-
-        # set up zipper
-        zipper = Zipper(dataset_handler)
+    # sensor logs to download or only unzip, with the zipper for their dataset
+    zippers = {}
+    downloads = []
+    unzips = []
+    queued = set()
+
+    # iterate datasets, grouped so each dataset's requests run back to back
+    for dataset in sorted(datasets, key=lambda dataset: dataset["dataset"]):
+        # set up zipper, once per dataset even if it is listed again
+        zipper = zippers.get(dataset["dataset"])
+        if zipper is None:
+            zipper = Zipper(args, DatasetHandler(args, dataset["dataset"]))
+            zippers[dataset["dataset"]] = zipper
+        dataset_handler = zipper.dataset_handler
 
         # iterate file patterns
         for file_pattern in dataset["file_patterns"]:
+            # already queued by an earlier listing
+            if (dataset["dataset"], file_pattern) in queued:
+                continue
+            queued.add((dataset["dataset"], file_pattern))
+
             # set up URL handler
             url_handler = URLHandler(dataset_handler, file_pattern)
 
-            # perform download
-            file_was_found = False
-            for i in range(args.nb_tries_reconnection):
-                try:
-                    file_was_found = scraper.scrape(url_handler)
-                    if file_was_found:
-                        break
-                except requests.exceptions.ChunkedEncodingError:
-                    print(
-                        "Connection broken on try {i+1}/5, wait {parse_args.reconnection_duration} seconds and restart downloading: ")
-                    time.sleep(args.reconnection_duration)
-
-            # unzip
-            if file_was_found:
-                zipper.unzip(url_handler)
-
-        # tidy up
-        zipper.tidy_up()
+            # extracted by an earlier run, with at least the members chosen now
+            if not args.overwrite and zipper.is_done(url_handler):
+                continue
+
+            # downloaded by an earlier run that stopped before unzipping it
+            if not args.overwrite and os.path.exists(url_handler.local_file_path):
+                unzips.append((zipper, url_handler))
+                continue
+
+            downloads.append((zipper, url_handler))
+
+    print("got num_downloads: " + str(len(downloads)))
+
+    # skip sensor logs the server does not have, probing concurrently
+    with ThreadPoolExecutor(max_workers=args.max_workers) as executor:
+        files_were_found = list(executor.map(
+            lambda download: scraper.probe(download[1]), downloads))
+    downloads = [download for download, file_was_found
+                 in zip(downloads, files_were_found) if file_was_found]
+
+    print("got num_found: " + str(len(downloads)))
+    print("got num_unzips: " + str(len(unzips)))
+
+    # downloads and unzips left per zipper
+    num_pending = defaultdict(int)
+    for zipper, url_handler in downloads + unzips:
+        num_pending[zipper] += 1
+
+    # nothing to wait for
+    for zipper in zippers.values():
+        if not num_pending[zipper]:
+            zipper.tidy_up()
+
+    # download sensor logs concurrently, unzipping on separate workers so
+    # that downloads carry on while archives are extracted
+    with ThreadPoolExecutor(max_workers=args.max_workers) as executor, \
+            ThreadPoolExecutor(max_workers=args.max_unzip_workers) as unzip_executor:
+        # zipper and url handler for each submitted download
+        download_futures = {
+            executor.submit(download, scraper, zipper, url_handler, args):
+                (zipper, url_handler)
+            for zipper, url_handler in downloads}
+
+        # zipper for each submitted unzip, starting with tars already on disk
+        unzip_futures = {
+            unzip_executor.submit(zipper.unzip, url_handler): zipper
+            for zipper, url_handler in unzips}
+
+        # tidy up each dataset once all of its downloads and unzips are done
+        pending = set(download_futures) | set(unzip_futures)
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in download_futures:
+                        zipper, url_handler = download_futures.pop(future)
+
+                        # unzip
+                        if future.result() and not args.stream_extract:
+                            unzip_future = unzip_executor.submit(
+                                zipper.unzip, url_handler)
+                            unzip_futures[unzip_future] = zipper
+                            pending.add(unzip_future)
+                            continue
+                    else:
+                        future.result()
+                        zipper = unzip_futures.pop(future)
+
+                    num_pending[zipper] -= 1
+                    if not num_pending[zipper]:
+                        zipper.tidy_up()
+        except BaseException:
+            # a failed download or Ctrl-C stops the run, so leave queued
+            # downloads and unzips unstarted rather than waiting on them
+            for future in pending:
+                future.cancel()
+            raise
 
     # console
     print("ScrapeMRGDatashare is finished!")